@@ -239,15 +239,16 @@ class GroundingDINO(nn.Module):
            - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
                             dictionnaries containing the two above keys for each decoder layer.
         """
-        if targets is None:
-            captions = kw["captions"]
-        else:
-            captions = [t["caption"] for t in targets]
-
-        # encoder texts
-        tokenized = self.tokenizer(captions, padding="longest", return_tensors="pt").to(
-            samples.device
-        )
+        # encoder texts; accept pre-tokenized captions so a fixed prompt is
+        # not re-tokenized on every forward
+        tokenized = kw.get("tokenized")
+        if tokenized is None:
+            if targets is None:
+                captions = kw["captions"]
+            else:
+                captions = [t["caption"] for t in targets]
+            tokenized = self.tokenizer(captions, padding="longest", return_tensors="pt")
+        tokenized = tokenized.to(samples.device)
         (
             text_self_attention_masks,
             position_ids,
@@ -0,0 +1,91 @@
+"""
+Fused Triton kernels for the grounding post-process.
+"""
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+
+    _HAS_TRITON = True
+except ImportError:
+    _HAS_TRITON = False
+
+
+if _HAS_TRITON:
+
+    @triton.jit
+    def _sigmoid_posmap_kernel(
+        logits_ptr, posmap_ptr, out_ptr,
+        Q, C,
+        stride_lb, stride_lq,
+        stride_ob, stride_oq,
+        T: tl.constexpr,
+        BLOCK_Q: tl.constexpr, BLOCK_C: tl.constexpr, BLOCK_T: tl.constexpr,
+    ):
+        # one program per (batch, query-block); pos_map tiles are reloaded
+        # from L2/SMEM across the T loop, logits are streamed exactly once
+        pid_b = tl.program_id(0)
+        pid_q = tl.program_id(1)
+
+        offs_q = pid_q * BLOCK_Q + tl.arange(0, BLOCK_Q)
+        offs_c = tl.arange(0, BLOCK_C)
+        q_mask = offs_q < Q
+        c_mask = offs_c < C
+
+        acc = tl.zeros((BLOCK_Q, BLOCK_C), dtype=tl.float32)
+        for t0 in range(0, T, BLOCK_T):
+            offs_t = t0 + tl.arange(0, BLOCK_T)
+            t_mask = offs_t < T
+            pm = tl.load(
+                posmap_ptr + offs_t[:, None] * C + offs_c[None, :],
+                mask=t_mask[:, None] & c_mask[None, :], other=0.0)
+            # masked logits read as -inf -> sigmoid 0 -> no contribution
+            logits = tl.load(
+                logits_ptr + pid_b * stride_lb
+                + offs_q[:, None] * stride_lq + offs_t[None, :],
+                mask=q_mask[:, None] & t_mask[None, :], other=float('-inf'))
+            # acc[q, c] = sum_t sigmoid(logits[q, t]) * pos_map_t[t, c]
+            acc += tl.dot(tl.sigmoid(logits.to(tl.float32)), pm)
+
+        tl.store(
+            out_ptr + pid_b * stride_ob
+            + offs_q[:, None] * stride_oq + offs_c[None, :],
+            acc, mask=q_mask[:, None] & c_mask[None, :])
+
+
+def fused_topk_available(tensor):
+    """Whether the fused post-process path can run for this tensor."""
+    return _HAS_TRITON and tensor.is_cuda
+
+
+def fused_sigmoid_posmap_topk(out_logits, pos_map_t, k):
+    """Compute topk(sigmoid(out_logits) @ pos_map_t) without materializing
+    the bs x Q x 256 sigmoid intermediate in HBM.
+
+    Parameters:
+        out_logits: [bs, Q, T] raw token logits
+        pos_map_t: [T, C] transposed category-to-token positive map
+        k: number of detections to keep per image
+
+    Returns (values, indices) with indices flattened as q * C + c, matching
+    torch.topk over the flattened [bs, Q * C] score tensor.
+    """
+    bs, Q, T = out_logits.shape
+    C = pos_map_t.shape[1]
+    pos_map_t = pos_map_t.contiguous()
+
+    prob = torch.empty((bs, Q, C), device=out_logits.device, dtype=torch.float32)
+    BLOCK_Q = 64
+    BLOCK_C = max(16, triton.next_power_of_2(C))
+    grid = (bs, triton.cdiv(Q, BLOCK_Q))
+    _sigmoid_posmap_kernel[grid](
+        out_logits, pos_map_t, prob,
+        Q, C,
+        out_logits.stride(0), out_logits.stride(1),
+        prob.stride(0), prob.stride(1),
+        T=T, BLOCK_Q=BLOCK_Q, BLOCK_C=BLOCK_C, BLOCK_T=64,
+    )
+    # k (=300) is far past the in-register selection-sort regime, and the
+    # fused output is only Q x C floats, so the global topk stays in torch
+    return torch.topk(prob.view(bs, -1), k, dim=1)